@@ -2,21 +2,46 @@
 Common code for manga metadata.
 """
 
+import copy
+import functools
 import json
 import os
 import re
 import shutil
+import struct
+import sys
 import tempfile
-import xml.etree.ElementTree
+import xml.sax.saxutils
 import zipfile
 
+# Prefer lxml (libxml2) for parsing XML, the stdlib ElementTree has the same API for what we use.
+try:
+    import lxml.etree as etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 ENCODING = 'utf-8'
 METADATA_FILENAME = 'ComicInfo.xml'
 METADATA_FILENAME_REGEX = r'ComicInfo\.xml'
 TEMP_ZIP_FILENAME = 'temp.zip'
+COPY_BUFFER_SIZE = 1 << 20
+
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+ZIP_ENCRYPTED_FLAG = 0x01
+ZIP64_EXTRA_ID = 0x0001
 
 class Metadata(object):
-    COMIC_INFO_KEY_ORDER = [
+    __slots__ = ('_data', '_notes')
+
+    COMIC_INFO_KEY_ORDER = (
         'Title', 'Series', 'Number', 'Count', 'Volume',
         'AlternateSeries', 'AlternateNumber', 'AlternateCount',
         'Summary', 'Notes', 'Year', 'Month', 'Day',
@@ -24,32 +49,45 @@ class Metadata(object):
         'Imprint', 'Genre', 'Web', 'PageCount', 'LanguageISO', 'Format', 'BlackAndWhite', 'Manga',
         'Characters', 'Teams', 'Locations', 'ScanInformation', 'StoryArc', 'SeriesGroup', 'AgeRating',
         'Pages', 'CommunityRating', 'MainCharacterOrTeam', 'Review'
-    ]
+    )
+
+    # {key: position in COMIC_INFO_KEY_ORDER}
+    COMIC_INFO_KEY_INDEX = {key: index for (index, key) in enumerate(COMIC_INFO_KEY_ORDER)}
 
-    def __init__(self, data = {}):
+    def __init__(self, data = None):
         self._data = {
             'Manga': 'Yes',
-            'Notes': '{}',
         }
 
-        self._data.update(data)
+        if (data):
+            self._data.update(data)
+
+        # Notes are kept as a live dict and only serialized on output.
+        self._notes = _parse_notes(self._data.pop('Notes', None))
 
     def __getitem__(self, key):
+        if (key == 'Notes'):
+            return _json_dumps(self._notes)
+
         return self._data[key]
 
     def __setitem__(self, key, value):
+        if (key == 'Notes'):
+            self._notes = _parse_notes(value)
+            return
+
         self._data[key] = value
 
     def put_note(self, key, value):
-        notes = json.loads(self._data['Notes'])
-        notes[key] = value
-        self._data['Notes'] = json.dumps(notes)
+        self._notes[key] = value
 
     def __repr__(self):
         return self.to_json()
 
     def copy(self):
-        return Metadata(data = dict(self._data))
+        metadata = Metadata(data = dict(self._data))
+        metadata._notes = dict(self._notes)
+        return metadata
 
     @staticmethod
     def from_cbz(path):
@@ -60,43 +98,122 @@ class Metadata(object):
                 # This archive contains no metadata.
                 return Metadata(), False
 
-            xml = archive.read(METADATA_FILENAME).decode(ENCODING)
-            return Metadata.from_xml(xml), True
+            # Let the parser read straight from the archive instead of decoding the whole file first.
+            with archive.open(METADATA_FILENAME, 'r') as file:
+                document = etree.parse(file).getroot()
+
+            return Metadata._from_document(document), True
 
     @staticmethod
     def from_xml(text):
-        document = xml.etree.ElementTree.fromstring(text)
+        return Metadata._from_document(etree.fromstring(text.encode(ENCODING)))
 
+    @staticmethod
+    def _from_document(document):
         data = {}
         for child in document:
+            # Skip comments and processing instructions.
+            if (not isinstance(child.tag, str)):
+                continue
+
             data[child.tag] = child.text
 
         return Metadata(data)
 
     def update(self, other):
         self._data.update(other._data)
+        self._notes = dict(other._notes)
 
     def to_xml(self):
-        root = xml.etree.ElementTree.Element('ComicInfo')
+        return b"\n".join(self._xml_lines()).decode(ENCODING)
 
-        for key in Metadata.COMIC_INFO_KEY_ORDER:
-            if (key not in self._data):
-                continue
+    def to_xml_bytes(self):
+        """
+        The XML document (with a trailing newline) ready to be written to a file.
+        """
+
+        lines = self._xml_lines()
+        lines.append(b'')
+        return b"\n".join(lines)
+
+    def _xml_lines(self):
+        """
+        The lines of the XML document, already encoded.
+        """
+
+        data = dict(self._data)
+        data['Notes'] = self['Notes']
+
+        # ComicInfo is a flat list of text elements, so just write it out directly instead of building a tree.
+        lines = [b'<ComicInfo>']
 
-            node = xml.etree.ElementTree.SubElement(root, key)
-            node.text = self._data[key]
+        # Only visit the keys that are actually set (typically a handful), in ComicInfo order.
+        keys = data.keys() & Metadata.COMIC_INFO_KEY_INDEX.keys()
+        for key in sorted(keys, key = Metadata.COMIC_INFO_KEY_INDEX.get):
+            lines.append(_xml_element(key, data[key]))
 
-        xml.etree.ElementTree.indent(root, space = '    ')
-        return xml.etree.ElementTree.tostring(root, encoding = 'unicode')
+        lines.append(b'</ComicInfo>')
+        return lines
 
     def write_xml(self, path):
-        with open(path, 'w') as file:
-            file.write(self.to_xml() + "\n")
+        with open(path, 'wb') as file:
+            file.write(self.to_xml_bytes())
 
     def to_json(self):
         output = dict(self._data)
-        output['Notes'] = json.loads(output['Notes'])
-        return json.dumps(output, indent = 4, sort_keys = True)
+        output['Notes'] = self._notes
+        return _json_dumps(output, pretty = True)
+
+# The same values (series, authors, publishers, ...) are written for every chapter in a batch.
+@functools.lru_cache(maxsize = 4096)
+def _xml_element(key, value):
+    """
+    A single (indented and encoded) ComicInfo line.
+    """
+
+    if (not value):
+        return ('    <%s />' % (key)).encode(ENCODING)
+
+    return ('    <%s>%s</%s>' % (key, xml.sax.saxutils.escape(value), key)).encode(ENCODING)
+
+def _json_dumps(value, pretty = False):
+    """
+    Serialize with orjson when available.
+    The stdlib fallback is configured to produce the same output.
+    """
+
+    if (orjson is not None):
+        options = 0
+        if (pretty):
+            options = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+
+        return orjson.dumps(value, option = options).decode(ENCODING)
+
+    if (pretty):
+        return json.dumps(value, indent = 2, sort_keys = True, ensure_ascii = False)
+
+    return json.dumps(value, separators = (',', ':'), ensure_ascii = False)
+
+def _json_loads(text):
+    if (orjson is not None):
+        return orjson.loads(text)
+
+    return json.loads(text)
+
+def _parse_notes(text):
+    if ((text is None) or (text.strip() == '')):
+        return {}
+
+    try:
+        notes = _json_loads(text)
+    except ValueError:
+        notes = None
+
+    if (not isinstance(notes, dict)):
+        # Notes written by other tools may be free-form text, keep it around.
+        notes = {'text': text}
+
+    return notes
 
 def get_int(lower, upper, prompt):
     prompt += ' (Enter "q" or "quit" to exit.): '
@@ -114,13 +231,15 @@ def get_int(lower, upper, prompt):
         if (text.lower() in ['q', 'quit']):
             return None
 
-        if (re.match(r'^\s*-?\d+\s*$', text) is None):
+        # Only accept plain (optionally negative) integers, int() alone would also take things like '+1' or '1_000'.
+        digits = text[1:] if text.startswith('-') else text
+        if (not digits.isdecimal()):
             continue
 
         value = int(text)
 
         if ((value < lower) or (value > upper)):
-            print("Int is out of bounds, must be in [%d, %d]." % (lower, upper))
+            sys.stderr.write("Int is out of bounds, must be in [%d, %d].\n" % (lower, upper))
             continue
 
         return value
@@ -129,14 +248,114 @@ def remove_metadata_from_zipfile(zip_path):
     return remove_from_zipfile(zip_path, METADATA_FILENAME_REGEX)
 
 def remove_from_zipfile(zip_path, filename_regex):
+    pattern = re.compile(filename_regex)
+
+    if (_truncate_zipfile(zip_path, pattern)):
+        return
+
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_path = os.path.join(temp_dir, TEMP_ZIP_FILENAME)
 
         with zipfile.ZipFile(zip_path, 'r') as old_archive:
             with zipfile.ZipFile(temp_path, 'w') as new_archive:
-                for item in old_archive.infolist():
-                    if (re.search(filename_regex, item.filename) is None):
-                        data = old_archive.read(item.filename)
-                        new_archive.writestr(item, data)
+                with open(zip_path, 'rb') as source:
+                    for item in old_archive.infolist():
+                        if (pattern.search(item.filename) is None):
+                            _copy_raw_zip_entry(source, new_archive, item)
 
         shutil.move(temp_path, zip_path)
+
+def _truncate_zipfile(zip_path, pattern):
+    """
+    If all the entries to remove are stored at the end of the archive (e.g. metadata that we appended),
+    then just cut them off and write a new central directory in place instead of rewriting the whole archive.
+    Returns True if the entries were removed (or there was nothing to remove).
+    """
+
+    with zipfile.ZipFile(zip_path, 'r') as archive:
+        items = sorted(archive.infolist(), key = lambda item: item.header_offset)
+
+    remove_count = len([item for item in items if (pattern.search(item.filename) is not None)])
+    if (remove_count == 0):
+        return True
+
+    remove_items = items[(len(items) - remove_count):]
+    if (any((pattern.search(item.filename) is None) for item in remove_items)):
+        return False
+
+    with zipfile.ZipFile(zip_path, 'a') as archive:
+        archive.filelist = [item for item in archive.filelist if (pattern.search(item.filename) is None)]
+        for item in remove_items:
+            archive.NameToInfo.pop(item.filename, None)
+
+        # On close, the central directory is written here and the rest of the file is truncated.
+        archive.start_dir = remove_items[0].header_offset
+        archive._didModify = True
+
+    return True
+
+def _copy_raw_zip_entry(source, archive, item):
+    """
+    Copy an entry into |archive| using the still-compressed bytes from |source| (the file behind |item|'s archive).
+    Nothing is decompressed or recompressed, only a new local header is written.
+    """
+
+    source.seek(item.header_offset)
+    header = source.read(ZIP_LOCAL_HEADER_SIZE)
+    if ((len(header) != ZIP_LOCAL_HEADER_SIZE) or (header[0:4] != ZIP_LOCAL_HEADER_SIGNATURE)):
+        raise zipfile.BadZipFile("Bad local file header for '%s'." % (item.filename))
+
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    data_start = item.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+    # The real CRC and sizes are already known (from the central directory),
+    # so any data descriptor is dropped and the values go straight into the new local header.
+    # Encrypted entries have to keep it, their password check byte depends on the flag.
+    descriptor = bool((item.flag_bits & ZIP_ENCRYPTED_FLAG) and (item.flag_bits & ZIP_DATA_DESCRIPTOR_FLAG))
+
+    new_item = copy.copy(item)
+    if (not descriptor):
+        new_item.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+    new_item.extra = _strip_zip64_extra(item.extra)
+    new_item.header_offset = archive.fp.tell()
+    archive.fp.write(new_item.FileHeader())
+
+    size = item.compress_size
+    source.seek(data_start)
+    while (size > 0):
+        data = source.read(min(size, COPY_BUFFER_SIZE))
+        if (len(data) == 0):
+            raise zipfile.BadZipFile("Truncated data for '%s'." % (item.filename))
+
+        archive.fp.write(data)
+        size -= len(data)
+
+    if (descriptor):
+        # Write a fresh descriptor instead of copying the old one, its format matches the new local header.
+        zip64 = ((item.file_size > zipfile.ZIP64_LIMIT) or (item.compress_size > zipfile.ZIP64_LIMIT))
+        format = '<4sLQQ' if zip64 else '<4sLLL'
+        archive.fp.write(struct.pack(format, ZIP_DATA_DESCRIPTOR_SIGNATURE, item.CRC, item.compress_size, item.file_size))
+
+    # Register the entry so that it makes it into the central directory when |archive| is closed.
+    archive.filelist.append(new_item)
+    archive.NameToInfo[new_item.filename] = new_item
+    archive.start_dir = archive.fp.tell()
+
+def _strip_zip64_extra(extra):
+    """
+    Drop any ZIP64 extra field, zipfile writes a fresh one when the entry needs it.
+    """
+
+    fields = []
+
+    index = 0
+    while (index + 4 <= len(extra)):
+        id, length = struct.unpack('<HH', extra[index:(index + 4)])
+        end = index + 4 + length
+
+        if (id != ZIP64_EXTRA_ID):
+            fields.append(extra[index:end])
+
+        index = end
+
+    return b''.join(fields)
@@ -3,15 +3,16 @@ Handle manga metadata.
 """
 
 import argparse
+import functools
 import sys
 
-import Levenshtein
-
 import manga.metadata.common
-import manga.metadata.sources
+
+# Heavy dependencies (HTTP, HTML parsing, string matching) are imported on first use,
+# so that callers like update.py that often exit early do not pay for them.
 
 def fetch(name, cache_dir = None, use_first = False):
-    source = manga.metadata.sources.MangaUpdates(cache_dir = cache_dir)
+    source = _get_source(cache_dir)
 
     results = source.search(name)
     if (len(results) == 0):
@@ -25,18 +26,43 @@ def fetch(name, cache_dir = None, use_first = False):
 
     return source.fetch(id)
 
+@functools.lru_cache(maxsize = None)
+def _get_source(cache_dir):
+    """
+    Share a source (and its remembered lookups) between all fetches in this process.
+    """
+
+    import manga.metadata.sources
+
+    return manga.metadata.sources.MangaUpdates(cache_dir = cache_dir)
+
+@functools.lru_cache(maxsize = None)
+def _import_rapidfuzz():
+    """
+    Returns the rapidfuzz module, or None if it is not installed (python-Levenshtein is used instead).
+    """
+
+    try:
+        import rapidfuzz.fuzz
+        import rapidfuzz.process
+    except ImportError:
+        return None
+
+    return rapidfuzz
+
 def _pick_result(name, results, use_first = False):
     if (len(results) == 1):
         return results[0][0], results[0][1]
 
-    sim_results = [(Levenshtein.ratio(name.lower(), result[1].lower()), result) for result in results]
-    sim_results.sort(reverse = True)
-
-    print("Found %d possible results matching '%s'." % (len(sim_results), name))
+    print("Found %d possible results matching '%s'." % (len(results), name))
 
     if (use_first):
-        print("Automatically choosing first result (%s)." % (sim_results[0][1][1]))
-        return sim_results[0][1][0], sim_results[0][1][1]
+        # Only the best match is needed, so skip scoring and sorting the full list.
+        id, title, description = _best_result(name, results)
+        print("Automatically choosing first result (%s)." % (title))
+        return id, title
+
+    sim_results = _score_results(name, results)
 
     for i in range(len(sim_results)):
         sim_score, (id, title, description) = sim_results[i]
@@ -48,6 +74,60 @@ def _pick_result(name, results, use_first = False):
 
     return sim_results[index][1][0], sim_results[index][1][1]
 
+def _best_result(name, results):
+    rapidfuzz = _import_rapidfuzz()
+    if (rapidfuzz is None):
+        import Levenshtein
+
+        query = name.lower()
+
+        best_result = None
+        best_score = -1.0
+
+        for result in results:
+            title = result[1].lower()
+
+            # The length difference is a lower bound on the edit distance,
+            # so skip titles whose best possible ratio cannot beat the current best.
+            total_length = len(query) + len(title)
+            if ((total_length > 0) and ((1.0 - abs(len(query) - len(title)) / total_length) <= best_score)):
+                continue
+
+            score = Levenshtein.ratio(query, title)
+            if (score > best_score):
+                best_result = result
+                best_score = score
+
+        return best_result
+
+    # extractOne() already bounds its work by the best score seen so far.
+    titles = [result[1] for result in results]
+    _, _, index = rapidfuzz.process.extractOne(name, titles, scorer = rapidfuzz.fuzz.ratio, processor = str.lower)
+    return results[index]
+
+def _score_results(name, results):
+    """
+    Returns: [
+        (similarity in [0, 1], result),
+        ...
+    ] (sorted by descending similarity).
+    """
+
+    rapidfuzz = _import_rapidfuzz()
+    if (rapidfuzz is None):
+        import Levenshtein
+
+        query = name.lower()
+        sim_results = [(Levenshtein.ratio(query, result[1].lower()), result) for result in results]
+        sim_results.sort(reverse = True)
+        return sim_results
+
+    # Score all titles in one batch, results come back ordered by descending score.
+    # The processor lowercases the query once and each title as it is scored.
+    titles = [result[1] for result in results]
+    matches = rapidfuzz.process.extract(name, titles, scorer = rapidfuzz.fuzz.ratio, processor = str.lower, limit = None)
+    return [(score / 100.0, results[index]) for (_, score, index) in matches]
+
 def main(args):
     metadata = fetch(args.name, args.cache_dir, args.use_first)
 
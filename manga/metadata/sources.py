@@ -3,18 +3,200 @@ Sources to fetch manga metadata from.
 """
 
 import abc
+import collections
+import hashlib
 import os
 import re
-import urllib.request
+import tempfile
+import threading
 
 import bs4
+import requests
+import requests.adapters
+
+# lxml is used for the search page when available, otherwise BeautifulSoup does all the parsing.
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
 
 import manga.metadata.common
 
+REQUEST_TIMEOUT_SEC = 30
+MAX_CONNECTIONS_PER_HOST = 8
+REQUEST_HEADERS = {
+    # Pages are mostly markup and compress well, requests transparently decodes the response.
+    'Accept-Encoding': 'gzip, deflate',
+    'User-Agent': 'manga-metadata/1.0',
+}
+MAX_CACHED_LOOKUPS = 256
+
+_WS_RE = re.compile(r'\s+')
+_SERIES_ID_RE = re.compile(r'www\.mangaupdates\.com/series/([^/]+)/')
+_YEAR_RE = re.compile(r'(\d{4})')
+
+# Link/button text that shows up inside the MangaUpdates genre and category sections.
+_GENRE_NOISE = frozenset({'Search for series of same genre(s)'})
+_TAG_NOISE = frozenset({'Log in to vote!', 'Show all (some hidden)'})
+
+def _has_classes(*names):
+    """
+    Build an XPath predicate matching elements that have all the given classes (like a CSS class selector).
+    """
+
+    checks = ["contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % (name) for name in names]
+    return '[' + ' and '.join(checks) + ']'
+
+if (lxml is not None):
+    # XPath equivalents of the CSS selectors for MangaUpdates search results.
+    _SEARCH_CARD_XPATH = lxml.etree.XPath('//div' + _has_classes('col-12', 'col-lg-6', 'p-3', 'text'))
+
+    # All the fields of a search result card are pulled with a single query, and then split up by node type.
+    _SEARCH_TITLE_PATH = './/div' + _has_classes('flex-column') + '/div' + _has_classes('text') + '/a[@alt="Series Info"]'
+    _SEARCH_YEAR_PATH = './/div' + _has_classes('d-flex', 'flex-column', 'h-100') + '//div' + _has_classes('text') + '[not(following-sibling::*)]'
+    _SEARCH_GENRES_PATH = './/div' + _has_classes('textsmall') + '//a'
+    _SEARCH_FIELDS_XPATH = lxml.etree.XPath(' | '.join([_SEARCH_TITLE_PATH, _SEARCH_YEAR_PATH, _SEARCH_GENRES_PATH]))
+
+def _read_search_cards(document):
+    """
+    Pull the raw fields out of each result card on a MangaUpdates search page (parsed with lxml).
+    Returns: [
+        ([(title href, title text), ...], [year text, ...], [genres title attribute, ...]),
+        ...
+    ]
+    """
+
+    cards = []
+    for node in _SEARCH_CARD_XPATH(document):
+        title_links = []
+        years = []
+        genres = []
+
+        for field in _SEARCH_FIELDS_XPATH(node):
+            if (field.tag == 'div'):
+                years.append(field.text_content())
+            elif (field.get('alt') == 'Series Info'):
+                title_links.append((field.get('href'), field.text_content()))
+            else:
+                genres.append(field.get('title'))
+
+        cards.append((title_links, years, genres))
+
+    return cards
+
+def _read_soup_search_cards(document):
+    """
+    Same as _read_search_cards(), but for a BeautifulSoup document (used when lxml is not available).
+    """
+
+    cards = []
+    for node in document.select('div.col-12.col-lg-6.p-3.text'):
+        title_links = [(link.get('href'), link.get_text()) for link in node.select('div.flex-column > div.text > a[alt="Series Info"]')]
+        years = [year.get_text() for year in node.select('div.d-flex.flex-column.h-100 div.text:last-child')]
+        genres = [link.get('title') for link in node.select('div.textsmall a')]
+
+        cards.append((title_links, years, genres))
+
+    return cards
+
+# Use the lxml tree builder when it is installed, the builtin parser is much slower but always available.
+if (bs4.builder.builder_registry.lookup('lxml') is not None):
+    SOUP_PARSER = 'lxml'
+else:
+    SOUP_PARSER = 'html.parser'
+
+def _parse_soup(data):
+    if (SOUP_PARSER == 'lxml'):
+        # lxml decodes the raw bytes itself.
+        return bs4.BeautifulSoup(data, SOUP_PARSER, from_encoding = manga.metadata.common.ENCODING)
+
+    return bs4.BeautifulSoup(data.decode(manga.metadata.common.ENCODING, errors = 'replace'), SOUP_PARSER)
+
+def _parse_html(data):
+    # Parsers are cheap to make, and a fresh one per call is safe to use from any thread.
+    parser = lxml.html.HTMLParser(encoding = manga.metadata.common.ENCODING)
+    return lxml.html.fromstring(data, parser = parser)
+
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session():
+    """
+    Get the process-wide HTTP session.
+    Sources are created per lookup and typically hit the same host over and over,
+    so sharing one session keeps connections alive across all of them.
+    """
+
+    global _session
+
+    with _session_lock:
+        if (_session is None):
+            session = requests.Session()
+            session.headers.update(REQUEST_HEADERS)
+
+            adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = MAX_CONNECTIONS_PER_HOST)
+            session.mount('https://', adapter)
+
+            _session = session
+
+    return _session
+
+class _Memo(object):
+    """
+    Remember the most recent results of a single argument function (like functools.lru_cache).
+    Unlike lru_cache, concurrent calls with the same argument wait for the first one to finish
+    instead of all running the (network bound) function at once.
+    """
+
+    def __init__(self, function, maxsize):
+        self._function = function
+        self._maxsize = maxsize
+
+        # Results keyed by argument, oldest first.
+        self._results = collections.OrderedDict()
+        # Locks for the arguments that are currently being computed.
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        with self._lock:
+            if (key in self._results):
+                self._results.move_to_end(key)
+                return self._results[key]
+
+            key_lock = self._pending.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread may have finished this key while we were waiting.
+            with self._lock:
+                if (key in self._results):
+                    self._results.move_to_end(key)
+                    return self._results[key]
+
+            try:
+                result = self._function(key)
+            except Exception:
+                # Like lru_cache, failures are not remembered and the next caller tries again.
+                with self._lock:
+                    self._pending.pop(key, None)
+                raise
+
+            with self._lock:
+                self._results[key] = result
+                if (len(self._results) > self._maxsize):
+                    self._results.popitem(last = False)
+
+                self._pending.pop(key, None)
+
+        return result
+
 class Source(abc.ABC):
     def __init__(self, cache_dir = None, **kwargs):
         self._cache_dir = cache_dir
 
+        self._session = _get_session()
+
     @abc.abstractmethod
     def search(self, name):
         """
@@ -36,24 +218,42 @@ class Source(abc.ABC):
 
         pass
 
+    def _get_cache_path(self, url):
+        """
+        URLs make poor paths (separators, query strings, length), so cache entries are keyed by a hash of the url.
+        The first two hex characters are used as a subdirectory to keep directories small.
+        """
+
+        key = hashlib.blake2b(url.encode(manga.metadata.common.ENCODING), digest_size = 16).hexdigest()
+        return os.path.join(self._cache_dir, key[:2], key[2:])
+
     def _fetch_url(self, url):
+        """
+        Returns the raw (undecoded) body of the page.
+        """
+
         cache_path = None
         if (self._cache_dir is not None):
-            cache_path = os.path.join(self._cache_dir, url)
+            cache_path = self._get_cache_path(url)
             if (os.path.isfile(cache_path)):
-                with open(cache_path, 'r') as file:
+                with open(cache_path, 'rb') as file:
                     return file.read()
 
-        with urllib.request.urlopen(url) as response:
-            data = response.read()
-            html = data.decode(manga.metadata.common.ENCODING, errors = 'replace')
+        response = self._session.get(url, timeout = REQUEST_TIMEOUT_SEC)
+        response.raise_for_status()
+        data = response.content
 
         if (cache_path is not None):
-            os.makedirs(os.path.dirname(cache_path), exist_ok = True)
-            with open(cache_path, 'w') as file:
-                file.write(html)
+            cache_dir = os.path.dirname(cache_path)
+            os.makedirs(cache_dir, exist_ok = True)
+
+            # Write to a temp file and move it into place, so concurrent fetches never see a partial entry.
+            with tempfile.NamedTemporaryFile('wb', dir = cache_dir, delete = False) as file:
+                file.write(data)
+
+            os.replace(file.name, cache_path)
 
-        return html
+        return data
 
 class MangaUpdates(Source):
     BASE_SEARCH_URL = 'https://www.mangaupdates.com/series.html?search=%s'
@@ -62,86 +262,107 @@ class MangaUpdates(Source):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+        # Batch updates look up the same series for every chapter, so remember lookups for the life of this source.
+        # Threaded updates ask for the same series at the same time, so those share a single lookup.
+        self._cached_search = _Memo(self._search, MAX_CACHED_LOOKUPS)
+        self._cached_fetch = _Memo(self._fetch, MAX_CACHED_LOOKUPS)
+
     def search(self, name):
-        name = re.sub(r'\s+', ' ', name).strip().replace(' ', '+')
+        return list(self._cached_search(name))
+
+    def fetch(self, id):
+        # Callers are free to modify the metadata they get back.
+        return self._cached_fetch(id).copy()
+
+    def _search(self, name):
+        name = _WS_RE.sub(' ', name).strip().replace(' ', '+')
         url = MangaUpdates.BASE_SEARCH_URL % (name)
 
-        html = self._fetch_url(url)
-        document = bs4.BeautifulSoup(html, 'html.parser')
+        if (lxml is not None):
+            cards = _read_search_cards(_parse_html(self._fetch_url(url)))
+        else:
+            cards = _read_soup_search_cards(_parse_soup(self._fetch_url(url)))
 
         results = []
-        for node in document.select('div.col-12.col-lg-6.p-3.text'):
-            title_link = node.select('div.flex-column > div.text > a[alt="Series Info"]')
-
-            if (len(title_link) != 1):
+        for (title_links, years, genres) in cards:
+            if (len(title_links) != 1):
                 continue
-            title_link = title_link[0]
+            href, title = title_links[0]
 
-            match = re.match(r'^.*www\.mangaupdates\.com/series/([^/]+)/.*$', title_link.get('href'))
+            match = _SERIES_ID_RE.search(href)
             if (match is None):
                 continue
 
             id = match.group(1)
-            title = title_link.get_text()
 
-            year_node = node.select('div.d-flex.flex-column.h-100 div.text:last-child')
-            if (len(year_node) != 1):
+            if (len(years) != 1):
                 continue
-            year_node = year_node[0]
 
-            match = re.match(r'^(\d{4}).*$', year_node.get_text())
+            match = _YEAR_RE.match(years[0])
             if (match is None):
                 year = '???'
             else:
                 year = match.group(1)
 
-            genres_node = node.select('div.textsmall a')
-            if (len(genres_node) != 1):
+            if (len(genres) != 1):
                 continue
-            genres_node = genres_node[0]
-
-            genres = genres_node.get('title')
+            genres = genres[0]
 
             results.append((id, title, "%s (%s) - %s" % (title, year, genres)))
 
         return results
 
-    def fetch(self, id):
+    def _fetch(self, id):
         metadata = manga.metadata.common.Metadata()
 
         url = MangaUpdates.BASE_FETCH_URL % (id)
-        html = self._fetch_url(url)
-        document = bs4.BeautifulSoup(html, 'html.parser')
+        document = _parse_soup(self._fetch_url(url))
 
         metadata['Title'] = document.select_one('span.releasestitle').get_text()
         metadata['Series'] = metadata['Title']
 
-        if (document.select_one('div#div_desc_more') is not None):
-            metadata['Summary'] = document.select_one('div#div_desc_more').contents[0].strip()
+        sections = self._index_sections(document)
+
+        description_node = document.find('div', id = 'div_desc_more')
+        if (description_node is not None):
+            # Only take the leading text, the rest of the node is the expand/collapse link.
+            metadata['Summary'] = description_node.contents[0].strip()
         else:
-            metadata['Summary'] = self._parse_single_section('Description', document)
+            metadata['Summary'] = self._parse_single_section('Description', sections)
 
-        metadata['Year'] = self._parse_single_section('Year', document)
-        metadata['Writer'] = ','.join(self._parse_multi_section('Author(s)', document))
-        metadata['Penciller'] = ','.join(self._parse_multi_section('Artist(s)', document))
-        metadata['Publisher'] = ','.join(self._parse_multi_section('Original Publisher', document))
+        metadata['Year'] = self._parse_single_section('Year', sections)
+        metadata['Writer'] = ','.join(self._parse_multi_section('Author(s)', sections))
+        metadata['Penciller'] = ','.join(self._parse_multi_section('Artist(s)', sections))
+        metadata['Publisher'] = ','.join(self._parse_multi_section('Original Publisher', sections))
         metadata['Web'] = url
 
-        self._parse_associated_name(document, metadata)
-        self._parse_genres(document, metadata)
-        self._parse_tags(document, metadata)
+        self._parse_associated_name(sections, metadata)
+        self._parse_genres(sections, metadata)
+        self._parse_tags(sections, metadata)
 
         return metadata
 
-    def _parse_single_section(self, label, document):
-        values = self._parse_multi_section(label, document)
+    def _index_sections(self, document):
+        """
+        Index the section headers (div.sCat) of a series page by their label,
+        so each section lookup does not need to search the whole document.
+        """
+
+        sections = {}
+        for header in document.find_all('div', 'sCat'):
+            sections.setdefault(header.get_text().strip(), header)
+
+        return sections
+
+    def _parse_single_section(self, label, sections):
+        values = self._parse_multi_section(label, sections)
         if ((values is None) or (len(values) == 0)):
             return None
 
         return values[0]
 
-    def _parse_multi_section(self, label, document):
-        header = document.find('div', 'sCat', string = label)
+    def _parse_multi_section(self, label, sections):
+        header = sections.get(label)
         if (header is None):
             return None
 
@@ -151,40 +372,33 @@ class MangaUpdates(Source):
 
         text = node.get_text("\n").strip()
 
-        values = [re.sub(r'\s+', ' ', name).strip() for name in text.split("\n")]
+        # Collapse runs of whitespace (split() with no arguments also drops leading/trailing whitespace).
+        values = [' '.join(name.split()) for name in text.split("\n")]
         values = [value for value in values if value != '']
-        values.sort()
 
         return values
 
-    def _parse_associated_name(self, document, metadata):
-        values = self._parse_multi_section('Associated Names', document)
+    def _parse_associated_name(self, sections, metadata):
+        values = self._parse_multi_section('Associated Names', sections)
         if (values is None):
             return
 
         metadata.put_note('associated_names', values)
 
-    def _parse_genres(self, document, metadata):
-        values = self._parse_multi_section('Genre', document)
+    def _parse_genres(self, sections, metadata):
+        values = self._parse_multi_section('Genre', sections)
         if (values is None):
             return
 
-        values.remove('Search for series of same genre(s)')
+        values = sorted(value for value in values if value not in _GENRE_NOISE)
 
         metadata['Genre'] = ','.join(values)
 
-    def _parse_tags(self, document, metadata):
-        values = self._parse_multi_section('Categories', document)
+    def _parse_tags(self, sections, metadata):
+        values = self._parse_multi_section('Categories', sections)
         if (values is None):
             return
 
-        remove_values = [
-            'Log in to vote!',
-            'Show all (some hidden)',
-        ]
-
-        for value in remove_values:
-            if (value in values):
-                values.remove(value)
+        values = sorted(value for value in values if value not in _TAG_NOISE)
 
         metadata['Tags'] = ','.join(values)
@@ -3,20 +3,27 @@ Update the metadata in an existing cbz archive.
 """
 
 import argparse
+import concurrent.futures
 import os
 import re
 import sys
+import time
 import zipfile
 
 import manga.metadata.common
 import manga.metadata.fetch
 
+DEFAULT_THREADS = 8
+
+# "<name> v<volume> c<chapter>.cbz"
+_ARCHIVE_RE = re.compile(r'^(.+)\s+v(\d+)\s+c(\d+[a-z]?)\.cbz$')
+
 def update(path, args):
     if (not os.path.isfile(path)):
         print("ERROR: No archive to update at '%s'." % (path))
         return 1
 
-    match = re.match(r'^(.+)\s+v(\d+)\s+c(\d+[a-z]?)\.cbz$', os.path.basename(path).strip())
+    match = _ARCHIVE_RE.match(os.path.basename(path).strip())
     if (match is None):
         print("ERROR: Cannot parse name/volume/chapter information from archive path: '%s'." % (path))
         return 1
@@ -45,19 +52,31 @@ def update(path, args):
     # Remove any existing metadata file.
     manga.metadata.common.remove_metadata_from_zipfile(path)
 
+    # The metadata is only a few KB, so store it as-is instead of deflating it.
+    info = zipfile.ZipInfo(manga.metadata.common.METADATA_FILENAME, date_time = time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_STORED
+
     with zipfile.ZipFile(path, 'a') as archive:
-        with archive.open(manga.metadata.common.METADATA_FILENAME, 'w') as file:
-            file.write((new_metadata.to_xml() + "\n").encode(manga.metadata.common.ENCODING))
+        archive.writestr(info, new_metadata.to_xml_bytes())
 
     return 0
 
 def main(args):
-    exit_status = 0
+    # Interactive runs prompt for choices, so those always go one archive at a time.
+    if ((not args.use_first) or (args.threads <= 1)):
+        exit_status = 0
 
-    for path in args.paths:
-        exit_status += update(path, args)
+        for path in args.paths:
+            exit_status += update(path, args)
 
-    return exit_status
+        return exit_status
+
+    # Updates are dominated by waiting on the network, so overlap them.
+    # The same archive is never handed to two threads.
+    paths = list(dict.fromkeys(args.paths))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.threads) as executor:
+        return sum(executor.map(lambda path: update(path, args), paths))
 
 def _load_args():
     parser = argparse.ArgumentParser(description = "Update the metadata in an existing cbz archive.")
@@ -74,6 +93,10 @@ def _load_args():
         action = 'store_true', default = False,
         help = 'when presented with choices, always choose the first option and do not prompt (default: %(default)s)')
 
+    parser.add_argument('--threads', dest = 'threads',
+        action = 'store', type = int, default = DEFAULT_THREADS,
+        help = 'the number of archives to update at once, only used with --first (default: %(default)s)')
+
     parser.add_argument('--no-clobber', dest = 'no_clobber',
         action = 'store_true', default = False,
         help = 'if metadata alreay exists, leave the archive alone (default: %(default)s)')